@@ -1,7 +1,9 @@
 import unittest
 from tinygrad import dtypes, Variable
+from tinygrad.dtype import PtrDType
 from tinygrad.ops import BinaryOps, TernaryOps
 from tinygrad.codegen.uops import UOpGraph, UOps
+from tinygrad.renderer.assembly import coalesce_loads
 
 class TestUOpGraph(unittest.TestCase):
   def test_add_constant_fold(self):
@@ -46,5 +48,46 @@ class TestUOpGraph(unittest.TestCase):
     self.assertEqual(out.uop, UOps.CONST)
     self.assertEqual(out.arg, 0)
 
+class TestCoalesceLoads(unittest.TestCase):
+  def test_contiguous_loads_merge_to_v4(self):
+    g = UOpGraph()
+    buf = g.add(UOps.DEFINE_GLOBAL, PtrDType(dtypes.float), arg=(0, "data0"))
+    lds = [g.add(UOps.LOAD, dtypes.float, (buf, g.add(UOps.CONST, dtypes.int, arg=i*4)), '.global') for i in range(4)]
+    out = lds[0]
+    for ld in lds[1:]: out = g.add(UOps.ALU, dtypes.float, (out, ld), BinaryOps.ADD)
+    coalesce_loads(g)
+    loads = [u for u in g.uops if u.uop is UOps.LOAD]
+    self.assertEqual(len(loads), 1)
+    self.assertEqual(loads[0].dtype, dtypes.float.vec(4))
+    self.assertEqual(len([u for u in g.uops if u.uop is UOps.GEP]), 4)
+    # users of the scalar loads now point at the GEPs
+    self.assertTrue(all(v.uop in {UOps.GEP, UOps.ALU} for u in g.uops if u.uop is UOps.ALU for v in u.vin))
+
+  def test_non_power_of_two_stride_blocks_v4(self):
+    # base + idx*24 is only provably 8-byte aligned, a v4 load from it would fault for odd idx
+    g = UOpGraph()
+    buf = g.add(UOps.DEFINE_GLOBAL, PtrDType(dtypes.float), arg=(0, "data0"))
+    v = g.add(UOps.DEFINE_VAR, dtypes.int, arg=Variable('idx', 0, 511))
+    c24 = g.add(UOps.CONST, dtypes.int, arg=24)
+    off = g.add(UOps.CAST, dtypes.uint64, (g.add(UOps.ALU, dtypes.int, (v, c24), BinaryOps.MUL),))
+    base = g.add(UOps.ALU, dtypes.uint64, (buf, off), BinaryOps.ADD)
+    lds = [g.add(UOps.LOAD, dtypes.float, (base, g.add(UOps.CONST, dtypes.int, arg=i*4)), '.global') for i in range(4)]
+    out = lds[0]
+    for ld in lds[1:]: out = g.add(UOps.ALU, dtypes.float, (out, ld), BinaryOps.ADD)
+    coalesce_loads(g)
+    self.assertEqual([u.dtype for u in g.uops if u.uop is UOps.LOAD], [dtypes.float.vec(2)]*2)
+
+  def test_no_merge_across_control_flow(self):
+    g = UOpGraph()
+    buf = g.add(UOps.DEFINE_GLOBAL, PtrDType(dtypes.float), arg=(0, "data0"))
+    lds = [g.add(UOps.LOAD, dtypes.float, (buf, g.add(UOps.CONST, dtypes.int, arg=i*4)), '.global') for i in range(2)]
+    c0 = g.add(UOps.CONST, dtypes.int, arg=0)
+    c8 = g.add(UOps.CONST, dtypes.int, arg=8)
+    g.add(UOps.LOOP, dtypes.int, (c0, c8), cachable=False)
+    lds += [g.add(UOps.LOAD, dtypes.float, (buf, g.add(UOps.CONST, dtypes.int, arg=i*4)), '.global') for i in range(2, 4)]
+    coalesce_loads(g)
+    # the run breaks at the LOOP, so each side only merges to a v2
+    self.assertEqual([u.dtype for u in g.uops if u.uop is UOps.LOAD], [dtypes.float.vec(2)]*2)
+
 if __name__ == '__main__':
   unittest.main(verbosity=2)
@@ -22,6 +22,7 @@ class UOp:
   dtype: Optional[DType] = None
   vin: Tuple[UOp, ...] = tuple()
   arg: Any = None
+  uid: int = -1 # position in the final uop list, assigned by the renderer so lookup tables can be flat lists
   def __repr__(self):
     return f"{str(self.uop):20s}: {str(self.dtype) if self.dtype is not None else '':25s} {str([x.uop for x in self.vin]):32s} {self.arg}"
   @staticmethod
@@ -59,26 +60,33 @@ def _match(uop:UOp, pattern:Dict[str, Any], store:Dict[str, UOp]) -> bool:
 class PatternMatcher:
   def __init__(self, patterns:List[Tuple[Dict[str, Any], Any]]):
     self.patterns = patterns
-    self.pdict = defaultdict(list)
+    self.pdict: Dict[Tuple[Optional[UOps], Any], List[Tuple[Dict[str, Any], Any]]] = {}
     # uop is required, arg is optional
-    for p,fxn in self.patterns: self.pdict[(p.get("uop"), p.get("arg", None))].append((p, fxn))
+    for p,fxn in self.patterns: self.pdict.setdefault((p.get("uop"), p.get("arg", None)), []).append((p, fxn))
 
   def rewrite(self, uop:UOp) -> Optional[UOp]:
-    for p,fxn in itertools.chain(self.pdict[(uop.uop, uop.arg)], self.pdict[(uop.uop, None)]):
-      store: Dict[str, UOp] = {}
-      if _match(uop, p, store): return fxn(**store)
+    # uops with no rules at all exit on two failed dict lookups, no match attempts
+    for rules in (self.pdict.get((uop.uop, uop.arg)), self.pdict.get((uop.uop, None))):
+      for p,fxn in rules or ():
+        store: Dict[str, UOp] = {}
+        if _match(uop, p, store): return fxn(**store)
     return None
 
   def rewrite_graph(self, uops: UOpGraph):
     replace: Dict[UOp, UOp] = {}
     seen: Set[UOp] = set()
+    # reverse index so a replacement only touches the uops that actually use the replaced one
+    uses: DefaultDict[UOp, List[UOp]] = defaultdict(list)
+    for u in uops:
+      for v in u.vin: uses[v].append(u)
     for u in uops:
       if u in seen: continue
       seen.add(u)
-      for o,n in replace.items():
-        if o in u.vin and u is not n:
-          u.vin = tuple(n if x == o else x for x in u.vin)
-      if rew := self.rewrite(u): replace[u] = rew
+      if rew := self.rewrite(u):
+        replace[u] = rew
+        for user in [x for x in uses[u] if x is not rew]:
+          user.vin = tuple(rew if x is u else x for x in user.vin)
+          uses[rew].append(user)
 
     for o,n in replace.items():
       queue = [n]